@@ -1,20 +1,52 @@
 from langchain_mcp_adapters.client import MultiServerMCPClient
 from src.agent import build_simple_agent
 from langchain_core.messages import HumanMessage, AIMessageChunk, AIMessage
-from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.runnables import RunnableConfig
+from src.checkpointer import BoundedMemorySaver
 import asyncio
+import contextlib
+import json
+import orjson
+import sys
+import uuid
 import warnings
 from src.prompt import BASE_SYSTEM_PROMPT
-from src.config.config import MCP_CONFIG, MCP_FILESYSTEM_DIR, LLM_MODEL
-from prompt_toolkit import prompt as pt_prompt
+from src.config.config import MCP_CONFIG, MCP_FILESYSTEM_DIR, LLM_MODEL, READONLY_MCP_SERVERS
+from prompt_toolkit import PromptSession
 
 warnings.filterwarnings("ignore", category=UserWarning)
 
+# 스트리밍 중 토큰마다 f-string을 만들지 않도록 ANSI 색상 코드를 미리 정의합니다.
+_CYAN, _RESET, _BOLD_GREEN, _BLUE, _GRAY, _BOLD, _RED = (
+    "\033[96m", "\033[0m", "\033[1;32m", "\033[94m", "\033[90m", "\033[1m", "\033[91m"
+)
+_AI_HEADER = "\n" + _BOLD_GREEN + "[AI]:" + _RESET + " "
+
+
+def mark_readonly_server_tools(server_name: str, tools: list) -> list:
+    # 조회 전용 서버의 도구에 readOnlyHint를 채워 agent가 동시 실행/캐시/재시도할 수 있게 합니다.
+    # 서버가 직접 어노테이션을 준 경우에는 그 값을 그대로 따릅니다.
+    if server_name in READONLY_MCP_SERVERS:
+        for tool in tools:
+            metadata = tool.metadata or {}
+            if metadata.get("readOnlyHint") is None:
+                tool.metadata = {**metadata, "readOnlyHint": True}
+    return tools
 
 async def load_tools_resilient(config_dict: dict, timeout_seconds: float = 120.0):
     client = MultiServerMCPClient(config_dict)
     try:
-        tools = await asyncio.wait_for(client.get_tools(), timeout=timeout_seconds)
+        # 도구가 어느 서버에서 왔는지 알 수 있도록 서버별로 (동시에) 불러옵니다.
+        server_names = list(config_dict)
+        tools_per_server = await asyncio.wait_for(
+            asyncio.gather(*(client.get_tools(server_name=name) for name in server_names)),
+            timeout=timeout_seconds,
+        )
+        tools = [
+            tool
+            for server_name, server_tools in zip(server_names, tools_per_server)
+            for tool in mark_readonly_server_tools(server_name, server_tools)
+        ]
         return tools, []
     except Exception as full_load_error:
         print("⚠️ 전체 서버 동시 로딩 실패. 서버별 개별 로딩으로 재시도합니다.")
@@ -28,7 +60,7 @@ async def load_tools_resilient(config_dict: dict, timeout_seconds: float = 120.0
         single_client = MultiServerMCPClient({server_name: server_cfg})
         try:
             server_tools = await asyncio.wait_for(single_client.get_tools(), timeout=timeout_seconds)
-            loaded_tools.extend(server_tools)
+            loaded_tools.extend(mark_readonly_server_tools(server_name, server_tools))
             print(f"✅ [{server_name}] {len(server_tools)}개 도구 로드")
         except Exception as server_error:
             failed_servers.append((server_name, server_error))
@@ -36,18 +68,29 @@ async def load_tools_resilient(config_dict: dict, timeout_seconds: float = 120.0
 
     return loaded_tools, failed_servers
 
-async def get_multiline_input(prompt: str) -> str:
+def summarize_tools(tools) -> str:
+    # Tool 객체의 repr 대신 이름/설명/인자 스키마만 담은 간결한 JSON으로 프롬프트 토큰을 줄입니다.
+    summaries = []
+    for tool in tools:
+        schema = tool.args_schema
+        if schema is not None and not isinstance(schema, dict):
+            # MCP 도구는 dict(JSON Schema), 일반 LangChain 도구는 pydantic 모델입니다.
+            schema = schema.model_json_schema() if hasattr(schema, "model_json_schema") else schema.schema()
+        summaries.append({"name": tool.name, "description": tool.description, "schema": schema})
+    try:
+        return orjson.dumps(summaries, default=str).decode()
+    except TypeError:
+        # orjson은 64비트를 넘는 정수 등을 직렬화하지 못하므로 표준 json으로 대신 만듭니다.
+        return json.dumps(summaries, ensure_ascii=False, default=str)
+
+async def get_multiline_input(session: PromptSession, prompt: str) -> str:
     # \033[96m: Cyan색, \033[1m: Bold, \033[0m: Reset
-    guide = "\033[96m\033[1m(전송: Esc 누른 후 Enter)\033[0m"
+    guide = _CYAN + _BOLD + "(전송: Esc 누른 후 Enter)" + _RESET
     print(f"{prompt} {guide}")
     # multiline=True일 때, 전송은 보통 'Esc' 누른 후 'Enter' 또는 'Meta+Enter'
     # 혹은 마우스로 클릭할 수 없는 환경이므로 안내 메시지가 필요합니다.
-    user_input = await asyncio.to_thread(
-        pt_prompt, 
-        "> ", 
-        multiline=True,
-        prompt_continuation="  " # 줄바꿈 시 앞에 붙는 접두어
-    )
+    # 세션을 재사용하므로 매 턴 초기화 없이 asyncio 루프에서 바로 입력을 받습니다.
+    user_input = await session.prompt_async("> ")
     return user_input.strip()
 
 async def stream_graph_response(input, graph, config={}):
@@ -61,6 +104,17 @@ async def stream_graph_response(input, graph, config={}):
         if metadata.get("langgraph_node") == "tools":
             continue
 
+        # 0. 빠른 경로: 대부분의 chunk는 도구 호출이 없는 일반 텍스트 토큰이므로 바로 출력합니다.
+        # (첫 텍스트의 [AI] 머리말, 문자열이 아닌 content, finish_reason이 있는 마지막 chunk는 아래 일반 경로에서 처리)
+        content = getattr(message_chunk, "content", None)
+        if (
+            content and not first_text and isinstance(content, str)
+            and not getattr(message_chunk, "tool_call_chunks", None)
+            and not message_chunk.response_metadata.get("finish_reason")
+        ):
+            yield content
+            continue
+
         # 1. AIMessage(완성본) 또는 AIMessageChunk(조각)인지 확인
         if isinstance(message_chunk, (AIMessage, AIMessageChunk)):
             
@@ -71,16 +125,16 @@ async def stream_graph_response(input, graph, config={}):
                     idx = chunk.get("index")
                     if idx != last_index:
                         if chunk.get("name"):
-                            yield f"\n\033[94m🛠️  Executing Tool: {chunk['name']}\033[0m\n"
+                            yield "\n" + _BLUE + "🛠️  Executing Tool: " + chunk["name"] + _RESET + "\n"
                             last_index = idx
                     if chunk.get("args"):
-                        yield f"\033[90m{chunk['args']}\033[0m"
+                        yield _GRAY + chunk["args"] + _RESET
             
             # 3. 일반 텍스트 내용(Content) 출력
             # 완성된 AIMessage(에러 중단 메시지 포함)와 Chunk의 텍스트를 모두 잡습니다.
             elif message_chunk.content:
                 if first_text:
-                    yield "\n\033[1;32m[AI]:\033[0m " 
+                    yield _AI_HEADER
                     first_text = False
                 
                 # content가 리스트 형태인 경우(멀티모달 등)를 대비해 문자열 변환
@@ -93,12 +147,64 @@ async def stream_graph_response(input, graph, config={}):
                     yield "\n"
                     last_index = -1
 
+async def write_buffered(chunks, flush_interval: float = 0.01, max_chunks: int = 16):
+    # 토큰 단위의 작은 출력을 모아서 한 번에 write/flush 하여 syscall 횟수를 줄입니다.
+    buffer: list[str] = []
+
+    def flush():
+        if buffer:
+            sys.stdout.write("".join(buffer))
+            sys.stdout.flush()
+            buffer.clear()
+
+    iterator = chunks.__aiter__()
+    next_chunk = None
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(iterator.__anext__())
+            # wait_for는 타임아웃 시 태스크를 취소하므로 asyncio.wait로 대기합니다.
+            # 버퍼가 비어 있으면 비울 것이 없으므로 타임아웃 없이 다음 chunk를 기다립니다.
+            done, _ = await asyncio.wait({next_chunk}, timeout=flush_interval if buffer else None)
+            if not done:
+                flush()
+                continue
+
+            try:
+                text = next_chunk.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                next_chunk = None
+
+            # 도구 실행 안내 등 색상 제어 문자열은 앞의 내용과 합치지 않고 바로 출력합니다.
+            if text.startswith("\n\033"):
+                flush()
+                buffer.append(text)
+                flush()
+                continue
+
+            buffer.append(text)
+            if len(buffer) >= max_chunks or "\n" in text:
+                flush()
+    finally:
+        if next_chunk is not None:
+            next_chunk.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await next_chunk
+        # 중간에 취소되더라도 스트림 제너레이터(graph.astream)를 정리합니다.
+        await chunks.aclose()
+        flush()
+
 async def run_mcp_agent():
 
     # Memory Configuration
-    memory = MemorySaver()
-    config = {
-        "configurable": {"thread_id": "thread_1"},
+    # 최신 체크포인트만 보관해 대화가 길어져도 체크포인트 메모리가 누적되지 않도록 합니다.
+    memory = BoundedMemorySaver()
+    # 실행(세션)마다 고유한 thread_id를 사용해 다른 세션의 체크포인트와 섞이지 않도록 합니다.
+    # 매 턴 같은 config 객체를 그대로 재사용합니다.
+    config: RunnableConfig = {
+        "configurable": {"thread_id": f"session_{uuid.uuid4().hex}"},
         "recursion_limit": 300} # 50번 이상의 도구 사용 가능
 
     # MCP Server Connection
@@ -133,6 +239,7 @@ async def run_mcp_agent():
         print("   가능한 서버들로 계속 진행합니다.\n")
     
     print(f"✅ Loaded {len(tools)} tools.")
+    tools_summary = summarize_tools(tools)
 
     system_prompt = f"""
     Your name is Scout and you are an expert data scientist.
@@ -150,7 +257,7 @@ async def run_mcp_agent():
     {BASE_SYSTEM_PROMPT}
 
     <tools>
-    {tools}
+    {tools_summary}
     </tools>
 
     Assist the customer in all aspects of their data science workflow.
@@ -164,12 +271,17 @@ async def run_mcp_agent():
         checkpointer=memory
     )
 
+    prompt_session = PromptSession(
+        multiline=True,
+        prompt_continuation="  " # 줄바꿈 시 앞에 붙는 접두어
+    )
+
     print("\n--- MCP Agent Started ---")
     print("종료하려면 'exit' 또는 'quit'을 입력하세요.")
 
     # 2. 반복 루프 시작
     while True:
-        user_input = await get_multiline_input("\n[User]: ")
+        user_input = await get_multiline_input(prompt_session, "\n[User]: ")
 
         if user_input.lower() in ["exit", "quit"]:
             print("👋 프로그램을 종료합니다.")
@@ -186,20 +298,25 @@ async def run_mcp_agent():
             print("\n🤖 ...", end="\n\n", flush=True)
             
             # 통합된 제너레이터 호출
-            async for text in stream_graph_response(msg, mcp_agent, config):
-                print(text, end="", flush=True)
+            await write_buffered(stream_graph_response(msg, mcp_agent, config))
             
             print("\n")
         
         except Exception as e:
                     # 이제 여기는 '그래프 내부' 에러가 아니라 '시스템 레벨' 에러만 잡힙니다.
-                    print(f"\n\033[91m🔴 치명적 시스템 오류 발생: {e}\033[0m")
+                    print(f"\n{_RED}🔴 치명적 시스템 오류 발생: {e}{_RESET}")
                     # 필요하다면 여기서만 아주 제한적으로 메모리 초기화를 고려할 수 있습니다.
 
 if __name__ == "__main__":
-    # 터미널 실행 시에는 아래 두 줄이 없어도 되지만, 노트북 환경 호환성을 위해 유지 가능
-    import nest_asyncio
-    nest_asyncio.apply()
+    # 이미 이벤트 루프가 실행 중인 환경(노트북 등)에서만 nest_asyncio를 적용합니다.
+    # 터미널 실행 시에는 import와 루프 패치를 모두 생략합니다.
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        import nest_asyncio
+        nest_asyncio.apply()
 
     try:
         # 비동기 에이전트 실행 루프
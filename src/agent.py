@@ -1,9 +1,17 @@
+import asyncio
+import orjson
+import time
+from collections import OrderedDict
 from langgraph.graph import StateGraph, START, END
 from langchain.chat_models import init_chat_model
 from langgraph.prebuilt import tools_condition
-from typing import Annotated, TypedDict, Any, Sequence
+from functools import lru_cache
+from typing import Annotated, TypedDict, Any, Optional, Sequence
+from langchain_core.runnables import RunnableConfig
 from langchain_core.messages import BaseMessage, AIMessage, ToolMessage, HumanMessage, SystemMessage
 from langgraph.graph.message import add_messages
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -13,9 +21,36 @@ def handle_tool_error(error: Exception) -> str:
     print(f"--- [🔴 Tool Error Log 🔴] ---\n{repr(error)}\n------------------------")
     return f"Error: {repr(error)}."
 
+# MCP stdio 서버의 일시적인 장애만 재시도합니다. (검증 오류 등은 재시도해도 같은 결과)
+# 타임아웃이 나도 서버에서는 실행되었을 수 있으므로, 재시도는 읽기 전용 도구에만 적용합니다.
+# MCP 세션은 읽기 타임아웃을 McpError(408)로, 서버 종료를 McpError(CONNECTION_CLOSED)로 전달합니다.
+# FileNotFoundError/PermissionError(npx/uvx 없음, 잘못된 경로 등)는 재시도해도 실패하므로 제외합니다.
+TRANSIENT_TOOL_ERRORS = (ConnectionError, TimeoutError, asyncio.TimeoutError)
+TRANSIENT_MCP_ERROR_CODES = {CONNECTION_CLOSED, 408}
+
+
+def _is_transient_tool_error(error: Exception) -> bool:
+    if isinstance(error, McpError):
+        return error.error.code in TRANSIENT_MCP_ERROR_CODES
+    return isinstance(error, TRANSIENT_TOOL_ERRORS)
+
+
+async def _call_with_retry(tool: Any, args: Any, max_retries: int = 3, base: float = 0.5) -> Any:
+    for attempt in range(max_retries):
+        try:
+            return await tool.ainvoke(args)
+        except Exception as error:
+            if attempt == max_retries - 1 or not _is_transient_tool_error(error):
+                raise
+            await asyncio.sleep(base * 2 ** attempt)
+
 class AgentState(TypedDict):
     messages: Annotated[Sequence[BaseMessage], add_messages]
     error_count: int
+    # 마지막으로 tool_calls를 포함한 AIMessage의 인덱스 (에러 계산 시 이 이후만 확인)
+    last_ai_tool_idx: int
+    # 새 사용자 입력으로 턴이 시작되었는지 (turn_start 노드가 설정, Agent가 첫 호출 후 해제)
+    turn_started: bool
 
 
 FILESYSTEM_TOOL_NAMES = {
@@ -28,57 +63,168 @@ FILESYSTEM_TOOL_NAMES = {
     "get_file_info",
     "list_allowed_directories",
     "read_multiple_files",
+    "read_text_file",
+    "read_media_file",
+    "edit_file",
+    "directory_tree",
+    "list_directory_with_sizes",
+}
+
+_PATH_ALIASES = ("directory_path", "dir_path", "file_path", "folder_path")
+
+
+# 인자가 같으면 결과도 같은 읽기 전용 도구 (캐시/동시 실행/재시도 대상)
+# MCP readOnlyHint 어노테이션이 없는 서버 버전을 위한 예비 목록입니다.
+FILESYSTEM_READONLY = {
+    "list_directory",
+    "read_file",
+    "get_file_info",
+    "list_allowed_directories",
+    "read_multiple_files",
+    "search_files",
+    "read_text_file",
+    "read_media_file",
+    "directory_tree",
+    "list_directory_with_sizes",
 }
 
 
+def is_readonly_tool(tool: Any) -> bool:
+    # langchain-mcp-adapters는 MCP 도구 어노테이션(readOnlyHint 등)을 tool.metadata에 넣어 줍니다.
+    read_only_hint = (getattr(tool, "metadata", None) or {}).get("readOnlyHint")
+    if read_only_hint is not None:
+        return bool(read_only_hint)
+    return tool.name in FILESYSTEM_READONLY
+
+
+class ToolResultCache:
+    """
+    읽기 전용 도구 결과를 (thread_id, 도구 이름, 인자) 기준으로 잠시 보관하는 LRU 캐시.
+    같은 호출이 반복될 때 MCP 서버 왕복을 생략합니다.
+    clear()는 모든 thread의 항목을 비웁니다. (파일시스템은 thread 간에 공유되므로 의도된 동작)
+    """
+
+    def __init__(self, maxsize: int = 256, ttl_seconds: float = 60.0) -> None:
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[tuple, tuple[float, str]] = OrderedDict()
+        # clear()마다 증가합니다. 호출 시작 시점의 값과 다르면 그 사이 쓰기가 있었다는 뜻입니다.
+        self.generation = 0
+
+    @staticmethod
+    def make_key(thread_id: Any, tool_name: str, tool_args: Any) -> Optional[tuple]:
+        try:
+            return (thread_id, tool_name, orjson.dumps(tool_args, default=str, option=orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS))
+        except TypeError:
+            # 64비트를 넘는 정수 등 orjson이 직렬화하지 못하는 인자는 캐시하지 않습니다.
+            return None
+
+    def get(self, key: tuple) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, content = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return content
+
+    def put(self, key: tuple, content: str, generation: Optional[int] = None) -> None:
+        # 호출 도중 캐시가 비워졌다면 쓰기 이전의 결과일 수 있으므로 저장하지 않습니다.
+        if generation is not None and generation != self.generation:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, content)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.generation += 1
+
+
 def normalize_filesystem_args(tool_name: str, tool_args: Any) -> Any:
     if tool_name not in FILESYSTEM_TOOL_NAMES or not isinstance(tool_args, dict):
         return tool_args
 
-    normalized = dict(tool_args)
+    path = tool_args.get("path")
+    if isinstance(path, str) and path:
+        return tool_args
+
+    normalized = tool_args
 
-    if "path" not in normalized:
-        for alias in ("directory_path", "dir_path", "file_path", "folder_path"):
-            if isinstance(normalized.get(alias), str):
-                normalized["path"] = normalized[alias]
+    if "path" not in tool_args:
+        for alias in _PATH_ALIASES:
+            alias_path = tool_args.get(alias)
+            if isinstance(alias_path, str):
+                normalized = {**tool_args, "path": alias_path}
                 break
 
-    if tool_name == "list_directory" and not isinstance(normalized.get("path"), str):
-        normalized["path"] = "."
-
-    if tool_name == "list_directory" and normalized.get("path", "") == "":
-        normalized["path"] = "."
+    if tool_name == "list_directory" and (not isinstance(normalized.get("path"), str) or normalized["path"] == ""):
+        normalized = {**normalized, "path": "."}
 
     return normalized
 
-def build_simple_agent(model: str, system_prompt: str, tools: Sequence[Any], checkpointer = None):
+@lru_cache(maxsize=32)
+def _system_message(system_prompt: str) -> SystemMessage:
+    # 같은 프롬프트에 대해서는 SystemMessage를 한 번만 만들어 재사용합니다.
+    return SystemMessage(content=system_prompt)
+
+def build_simple_agent(model: str, system_prompt: str, tools: Sequence[Any], checkpointer = None, retry_base_delay: float = 0.5, tool_cache: Optional[ToolResultCache] = None):
+    # 대화별 상태는 checkpointer가 configurable.thread_id 기준으로 보관하고,
+    # configurable.system_prompt를 넘기면 같은 그래프로 다른 프롬프트를 사용할 수 있습니다.
+    # 단, 그래프가 상태를 전혀 갖지 않는 것은 아닙니다. tool_cache(읽기 전용 도구 결과)는 그래프의 모든 thread가 공유하며,
+    # 항목은 thread_id로 구분되지만 쓰기가 일어나면 전체가 비워집니다. 넘기지 않으면 그래프마다 새로 만듭니다.
     llm = init_chat_model(model=model)
     llm_with_tools = llm.bind_tools(tools)
     tool_by_name = {tool.name: tool for tool in tools}
+    tool_by_name_get = tool_by_name.get
+    readonly_tool_names = {tool.name for tool in tools if is_readonly_tool(tool)}
+    # 시스템 프롬프트는 턴마다 새로 만들지 않고 한 번만 생성해 재사용합니다.
+    default_system_msg = _system_message(system_prompt)
+
+    def resolve_system_msg(config: RunnableConfig) -> SystemMessage:
+        prompt_override = config.get("configurable", {}).get("system_prompt")
+        return _system_message(prompt_override) if prompt_override else default_system_msg
+
+    async def turn_start_node(state: AgentState) -> AgentState:
+        # 그래프는 사용자 입력이 들어올 때만 START부터 실행되므로, 턴마다 한 번만 여기서 확인합니다.
+        messages = state["messages"]
+        if messages and isinstance(messages[-1], HumanMessage):
+            return {"error_count": 0, "turn_started": True, "last_ai_tool_idx": len(messages) - 1}
+        return {"turn_started": False}
 
-    async def agent_node(state: AgentState) -> AgentState:
+    async def agent_node(state: AgentState, config: RunnableConfig) -> AgentState:
         messages = state["messages"]
         current_errors = state.get("error_count", 0)
 
         # 🌟 [핵심 추가] 사용자가 새로운 입력을 했다면 에러 카운트를 0으로 초기화
-        # 마지막 메시지가 HumanMessage라면 사용자가 새로운 시도를 하려는 것이므로 카운트를 리셋합니다.
+        # turn_start 노드가 새 HumanMessage를 확인하고 카운트를 리셋해 두었습니다.
         # 1. 새로운 질문 시 완전 초기화 후 즉시 모델 호출로 점프
-        if messages and isinstance(messages[-1], HumanMessage):
-            current_errors = 0
+        if state.get("turn_started"):
             # 과거 에러 계산 루프를 타지 않고 바로 모델 호출로 넘깁니다.
-            llm_input = [SystemMessage(content=system_prompt), *messages]
+            llm_input = [resolve_system_msg(config), *messages]
             response = await llm_with_tools.ainvoke(llm_input)
             # (로그 출력 로직 생략)
-            return {"messages": [response], "error_count": 0}
+            last_ai_tool_idx = len(messages) if response.tool_calls else len(messages) - 1
+            return {"messages": [response], "error_count": 0, "last_ai_tool_idx": last_ai_tool_idx, "turn_started": False}
 
         # 2. 툴 결과에 대한 에러 계산 (사용자 질문이 아닐 때만 이 아래가 실행됨)
+        # 직전 도구 호출 이후의 메시지만 확인하므로 대화 길이와 무관하게 O(이번 도구 호출 수)입니다.
+        last_ai_tool_idx = state.get("last_ai_tool_idx", -1)
+        if not 0 <= last_ai_tool_idx < len(messages):
+            # 이전 버전 체크포인트 등으로 인덱스가 없다면 역방향 탐색으로 한 번 복구합니다.
+            last_ai_tool_idx = next(
+                (i for i in range(len(messages) - 1, -1, -1)
+                 if isinstance(messages[i], AIMessage) and messages[i].tool_calls),
+                len(messages) - 1,
+            )
+
         new_errors = 0
-        for msg in reversed(messages):
-            if isinstance(msg, ToolMessage):
-                if "Error:" in msg.content:
-                    new_errors += 1
-            elif isinstance(msg, AIMessage) and msg.tool_calls:
-                break
+        for msg in messages[last_ai_tool_idx + 1:]:
+            if isinstance(msg, ToolMessage) and msg.additional_kwargs.get("is_error"):
+                new_errors += 1
 
         if new_errors > 0:
             current_errors += new_errors
@@ -87,15 +233,16 @@ def build_simple_agent(model: str, system_prompt: str, tools: Sequence[Any], che
             if messages and isinstance(messages[-1], ToolMessage):
                 current_errors = 0
 
-        # 3. 임계치 체크
+        # 3. 임계치 체크 (시스템 메시지와 입력 리스트를 만들기 전에 먼저 확인합니다)
         if current_errors >= 5:
             return {
                 "messages": [AIMessage(content="🔴 다수의 도구 호출에서 연속적인 오류가 발생했습니다.")],
-                "error_count": current_errors
+                "error_count": current_errors,
+                "last_ai_tool_idx": last_ai_tool_idx
             }
         
         # 4. 모델 호출 (툴 결과를 보고 다시 판단해야 할 때)
-        llm_input = [SystemMessage(content=system_prompt), *messages]
+        llm_input = [resolve_system_msg(config), *messages]
         response = await llm_with_tools.ainvoke(llm_input)
 
         # # 4. 🔥 [최종 로그 확인 영역] 🔥
@@ -127,13 +274,65 @@ def build_simple_agent(model: str, system_prompt: str, tools: Sequence[Any], che
         # print("="*85 + "\n")
 
         # 여기서 직접 print하지 않고 response만 반환합니다.
+        if response.tool_calls:
+            last_ai_tool_idx = len(messages)
+
         return {
             "messages": [response],
-            "error_count": current_errors}
+            "error_count": current_errors,
+            "last_ai_tool_idx": last_ai_tool_idx}
     
     workflow = StateGraph(AgentState)
 
-    async def tools_node(state: AgentState) -> AgentState:
+    if tool_cache is None:
+        tool_cache = ToolResultCache()
+
+    async def invoke_tool_call(tool_call: dict, thread_id: Any = None) -> ToolMessage:
+        # ToolCall TypedDict는 name/id 키를 항상 가지므로 직접 인덱싱합니다.
+        tool_name = tool_call["name"]
+        tool_call_id = tool_call["id"] or ""
+        raw_args = tool_call.get("args") or {}
+        tool_args = normalize_filesystem_args(tool_name, raw_args)
+
+        tool = tool_by_name_get(tool_name)
+        if tool is None:
+            error_text = handle_tool_error(Exception(f"Tool not found: {tool_name}"))
+            return ToolMessage(content=error_text, tool_call_id=tool_call_id, name=tool_name, additional_kwargs={"is_error": True})
+
+        is_readonly = tool_name in readonly_tool_names
+        cache_key = tool_cache.make_key(thread_id, tool_name, tool_args) if is_readonly else None
+        if cache_key is not None:
+            cached_content = tool_cache.get(cache_key)
+            if cached_content is not None:
+                return ToolMessage(content=cached_content, tool_call_id=tool_call_id, name=tool_name)
+
+        cache_generation = tool_cache.generation
+        is_error = False
+        try:
+            max_retries = 3 if is_readonly else 1
+            result = await _call_with_retry(tool, tool_args, max_retries=max_retries, base=retry_base_delay)
+            if isinstance(result, ToolMessage):
+                content = result.content
+            elif isinstance(result, str):
+                content = result
+            else:
+                content = str(result)
+            if cache_key is not None:
+                tool_cache.put(cache_key, content, cache_generation)
+        except Exception as error:
+            content = handle_tool_error(error)
+            is_error = True
+
+        if not is_readonly:
+            # 쓰기 등 다른 도구는 (실패했더라도) 파일 상태를 바꿀 수 있으므로 캐시를 비웁니다.
+            # 작업 디렉토리는 모든 thread가 공유하므로 다른 thread의 항목까지 일부러 모두 비웁니다.
+            tool_cache.clear()
+
+        # agent_node가 본문 문자열을 검색하지 않고 이 플래그로 에러를 셉니다.
+        additional_kwargs = {"is_error": True} if is_error else {}
+        return ToolMessage(content=content, tool_call_id=tool_call_id, name=tool_name, additional_kwargs=additional_kwargs)
+
+    async def tools_node(state: AgentState, config: RunnableConfig) -> AgentState:
         messages = state["messages"]
         if not messages:
             return {"messages": [], "error_count": state.get("error_count", 0)}
@@ -142,38 +341,34 @@ def build_simple_agent(model: str, system_prompt: str, tools: Sequence[Any], che
         if not isinstance(last_message, AIMessage) or not last_message.tool_calls:
             return {"messages": [], "error_count": state.get("error_count", 0)}
 
+        thread_id = config.get("configurable", {}).get("thread_id")
         tool_results: list[ToolMessage] = []
+        readonly_batch: list[dict] = []
+
+        async def flush_readonly_batch():
+            # 연속된 읽기 전용 호출은 서로 독립적이므로 동시에 실행합니다. (gather는 입력 순서대로 결과를 반환)
+            if readonly_batch:
+                tool_results.extend(await asyncio.gather(
+                    *(invoke_tool_call(tool_call, thread_id) for tool_call in readonly_batch)
+                ))
+                readonly_batch.clear()
 
         for tool_call in last_message.tool_calls:
-            tool_name = tool_call.get("name", "")
-            tool_call_id = tool_call.get("id", "")
-            raw_args = tool_call.get("args", {})
-            tool_args = normalize_filesystem_args(tool_name, raw_args)
-
-            tool = tool_by_name.get(tool_name)
-            if tool is None:
-                error_text = handle_tool_error(Exception(f"Tool not found: {tool_name}"))
-                tool_results.append(ToolMessage(content=error_text, tool_call_id=tool_call_id, name=tool_name))
+            if tool_call["name"] in readonly_tool_names:
+                readonly_batch.append(tool_call)
                 continue
-
-            try:
-                result = await tool.ainvoke(tool_args)
-                if isinstance(result, ToolMessage):
-                    content = result.content
-                elif isinstance(result, str):
-                    content = result
-                else:
-                    content = str(result)
-            except Exception as error:
-                content = handle_tool_error(error)
-
-            tool_results.append(ToolMessage(content=content, tool_call_id=tool_call_id, name=tool_name))
+            # 쓰기/코드 실행 등 부수 효과가 있을 수 있는 호출은 앞선 호출이 끝난 뒤 LLM이 요청한 순서대로 실행합니다.
+            await flush_readonly_batch()
+            tool_results.append(await invoke_tool_call(tool_call, thread_id))
+        await flush_readonly_batch()
 
         return {"messages": tool_results, "error_count": state.get("error_count", 0)}
 
+    workflow.add_node("turn_start", turn_start_node)
     workflow.add_node("Agent", agent_node)
     workflow.add_node("tools", tools_node)
-    workflow.add_edge(START, "Agent")
+    workflow.add_edge(START, "turn_start")
+    workflow.add_edge("turn_start", "Agent")
     workflow.add_conditional_edges(
         "Agent",
         tools_condition,
@@ -0,0 +1,49 @@
+from typing import Any
+from langgraph.checkpoint.memory import MemorySaver
+
+
+class BoundedMemorySaver(MemorySaver):
+    """
+    스레드(thread_id)마다 최근 체크포인트 `max_checkpoints`개만 보관하는 MemorySaver.
+    대화가 길어져도 과거 체크포인트와 그 채널 blob이 누적되지 않아 메모리 사용량이 일정하게 유지됩니다.
+    (time-travel 기능은 사용하지 않으므로 최신 상태만 있으면 충분합니다.)
+    """
+
+    def __init__(self, *args: Any, max_checkpoints: int = 1, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.max_checkpoints = max(1, max_checkpoints)
+        # (thread_id, checkpoint_ns) -> {checkpoint_id: channel_versions}
+        # 저장된 체크포인트를 다시 역직렬화하지 않고도 어떤 blob을 지울지 알 수 있도록 따로 보관합니다.
+        self._channel_versions: dict[tuple, dict[str, dict]] = {}
+
+    def put(self, config, checkpoint, metadata, new_versions):
+        next_config = super().put(config, checkpoint, metadata, new_versions)
+        thread_id = next_config["configurable"]["thread_id"]
+        checkpoint_ns = next_config["configurable"]["checkpoint_ns"]
+        versions_by_id = self._channel_versions.setdefault((thread_id, checkpoint_ns), {})
+        versions_by_id[checkpoint["id"]] = dict(checkpoint["channel_versions"])
+        self._prune(thread_id, checkpoint_ns, versions_by_id)
+        return next_config
+
+    def _prune(self, thread_id: str, checkpoint_ns: str, versions_by_id: dict[str, dict]) -> None:
+        if len(versions_by_id) <= self.max_checkpoints:
+            return
+
+        # 삽입 순서를 유지하므로 앞쪽이 오래된 체크포인트입니다.
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        stale_versions = set()
+        for checkpoint_id in list(versions_by_id)[:-self.max_checkpoints]:
+            stale_versions.update(versions_by_id.pop(checkpoint_id).items())
+            checkpoints.pop(checkpoint_id, None)
+            self.writes.pop((thread_id, checkpoint_ns, checkpoint_id), None)
+
+        # 삭제된 체크포인트만 참조하던 채널 버전의 blob을 지웁니다. (채널 수에 비례, 전체 blob 탐색 없음)
+        for versions in versions_by_id.values():
+            stale_versions.difference_update(versions.items())
+        for channel, version in stale_versions:
+            self.blobs.pop((thread_id, checkpoint_ns, channel, version), None)
+
+    def delete_thread(self, thread_id: str) -> None:
+        super().delete_thread(thread_id)
+        for key in [key for key in self._channel_versions if key[0] == thread_id]:
+            del self._channel_versions[key]
@@ -52,6 +52,10 @@ mcp_config = resolve_env_vars(config)
 MCP_CONFIG = mcp_config["mcpServers"]
 MCP_FILESYSTEM_DIR = os.getenv("MCP_FILESYSTEM_DIR")
 LLM_MODEL = "gpt-5-mini"
+# 부수 효과 없이 조회만 하는 MCP 서버. 이 서버의 도구는 readOnlyHint가 없으면 읽기 전용으로 표시되어
+# 동시 실행/캐시/재시도 대상이 됩니다.
+# sequential-thinking은 도구 호출마다 새 세션이 열려 서버에 상태가 남지 않으므로 포함합니다.
+READONLY_MCP_SERVERS = {"pubmed-server", "pdb-server", "ensembl", "ddg-search", "sequential-thinking"}
 
 print("-"*50)
 print(f"Current LLM Model: {LLM_MODEL}")
@@ -0,0 +1,367 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("langgraph")
+
+import src.agent as agent
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.tools import tool
+from mcp.shared.exceptions import McpError
+from mcp.types import CONNECTION_CLOSED, INVALID_PARAMS, ErrorData
+
+
+class ScriptedModel:
+    # 정해진 AIMessage를 순서대로 돌려주는 가짜 채팅 모델
+    def __init__(self, replies):
+        self.replies = replies
+
+    def bind_tools(self, tools):
+        return self
+
+    async def ainvoke(self, messages):
+        return self.replies.pop(0)
+
+
+def test_cache_entry_expires_after_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(agent.time, "monotonic", lambda: now[0])
+    cache = agent.ToolResultCache(ttl_seconds=60.0)
+    key = cache.make_key("t", "read_file", {"path": "a.txt"})
+
+    cache.put(key, "hello")
+    now[0] += 59.0
+    assert cache.get(key) == "hello"
+    now[0] += 2.0
+    assert cache.get(key) is None
+
+
+def test_cache_evicts_least_recently_used():
+    cache = agent.ToolResultCache(maxsize=2)
+    keys = [cache.make_key("t", "read_file", {"path": name}) for name in ("a", "b", "c")]
+
+    cache.put(keys[0], "a")
+    cache.put(keys[1], "b")
+    assert cache.get(keys[0]) == "a"
+    cache.put(keys[2], "c")
+
+    assert cache.get(keys[0]) == "a"
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) == "c"
+
+
+def test_cache_skips_put_after_clear():
+    cache = agent.ToolResultCache()
+    key = cache.make_key("t", "read_file", {"path": "a.txt"})
+
+    generation = cache.generation
+    cache.clear()
+    cache.put(key, "stale", generation)
+    assert cache.get(key) is None
+
+    cache.put(key, "fresh", cache.generation)
+    assert cache.get(key) == "fresh"
+
+
+def test_read_after_write_in_same_batch_is_not_stale(tmp_path, monkeypatch):
+    target = tmp_path / "a.txt"
+    target.write_text("hello")
+
+    @tool
+    async def read_file(path: str) -> str:
+        """Read a file."""
+        content = target.read_text()
+        await asyncio.sleep(0.05)
+        return content
+
+    @tool
+    async def write_file(path: str, content: str) -> str:
+        """Write a file."""
+        target.write_text(content)
+        return "ok"
+
+    replies = [
+        AIMessage(content="", tool_calls=[
+            {"name": "read_file", "args": {"path": "a.txt"}, "id": "1"},
+            {"name": "write_file", "args": {"path": "a.txt", "content": "NEW"}, "id": "2"},
+        ]),
+        AIMessage(content="", tool_calls=[{"name": "read_file", "args": {"path": "a.txt"}, "id": "3"}]),
+        AIMessage(content="done"),
+    ]
+
+    monkeypatch.setattr(agent, "init_chat_model", lambda model: ScriptedModel(replies))
+    graph = agent.build_simple_agent("fake", "system", [read_file, write_file])
+
+    result = asyncio.run(graph.ainvoke({"messages": [HumanMessage(content="go")]}))
+
+    last_read = [m for m in result["messages"] if getattr(m, "tool_call_id", None) == "3"][0]
+    assert last_read.content == "NEW"
+
+
+def test_mutating_calls_run_in_emitted_order(monkeypatch):
+    events = []
+
+    @tool
+    async def create_directory(path: str) -> str:
+        """Create a directory."""
+        await asyncio.sleep(0.05)
+        events.append("create_directory")
+        return "ok"
+
+    @tool
+    async def write_file(path: str, content: str) -> str:
+        """Write a file."""
+        events.append("write_file")
+        return "ok"
+
+    replies = [
+        AIMessage(content="", tool_calls=[
+            {"name": "create_directory", "args": {"path": "runs/Q1"}, "id": "1"},
+            {"name": "write_file", "args": {"path": "runs/Q1/x.py", "content": ""}, "id": "2"},
+        ]),
+        AIMessage(content="done"),
+    ]
+
+    monkeypatch.setattr(agent, "init_chat_model", lambda model: ScriptedModel(replies))
+    graph = agent.build_simple_agent("fake", "system", [create_directory, write_file])
+
+    result = asyncio.run(graph.ainvoke({"messages": [HumanMessage(content="go")]}))
+
+    assert events == ["create_directory", "write_file"]
+    assert [getattr(m, "tool_call_id", None) for m in result["messages"][2:4]] == ["1", "2"]
+
+
+def test_bounded_saver_keeps_only_latest_checkpoint(monkeypatch):
+    from src.checkpointer import BoundedMemorySaver
+
+    monkeypatch.setattr(agent, "init_chat_model", lambda model: ScriptedModel([AIMessage(content="one"), AIMessage(content="two")]))
+    saver = BoundedMemorySaver()
+    graph = agent.build_simple_agent("fake", "system", [], checkpointer=saver)
+    config = {"configurable": {"thread_id": "t"}}
+
+    asyncio.run(graph.ainvoke({"messages": [HumanMessage(content="first")]}, config))
+    asyncio.run(graph.ainvoke({"messages": [HumanMessage(content="second")]}, config))
+
+    assert len(saver.storage["t"][""]) == 1
+    latest = saver.get_tuple(config).checkpoint
+    live_blobs = {(channel, version) for _, _, channel, version in saver.blobs}
+    assert live_blobs <= set(latest["channel_versions"].items())
+    assert [m.content for m in latest["channel_values"]["messages"]] == ["first", "one", "second", "two"]
+
+
+def test_only_readonly_tools_are_retried(monkeypatch):
+    attempts = {"read_file": 0, "write_file": 0}
+
+    @tool
+    async def read_file(path: str) -> str:
+        """Read a file."""
+        attempts["read_file"] += 1
+        if attempts["read_file"] < 3:
+            raise ConnectionError("pipe closed")
+        return "hello"
+
+    @tool
+    async def write_file(path: str, content: str) -> str:
+        """Write a file."""
+        attempts["write_file"] += 1
+        raise TimeoutError("no reply")
+
+    replies = [
+        AIMessage(content="", tool_calls=[
+            {"name": "read_file", "args": {"path": "a.txt"}, "id": "1"},
+            {"name": "write_file", "args": {"path": "a.txt", "content": "NEW"}, "id": "2"},
+        ]),
+        AIMessage(content="done"),
+    ]
+    monkeypatch.setattr(agent, "init_chat_model", lambda model: ScriptedModel(replies))
+    graph = agent.build_simple_agent("fake", "system", [read_file, write_file], retry_base_delay=0)
+
+    result = asyncio.run(graph.ainvoke({"messages": [HumanMessage(content="go")]}))
+
+    assert attempts == {"read_file": 3, "write_file": 1}
+    tool_messages = result["messages"][2:4]
+    assert tool_messages[0].content == "hello"
+    assert tool_messages[1].additional_kwargs.get("is_error")
+
+
+def test_retry_follows_mcp_error_codes(monkeypatch):
+    attempts = {"read_file": 0, "list_directory": 0, "get_file_info": 0}
+
+    @tool
+    async def read_file(path: str) -> str:
+        """Read a file."""
+        # MCP 세션이 실제로 던지는 오류: 서버 종료 후 읽기 타임아웃
+        attempts["read_file"] += 1
+        if attempts["read_file"] == 1:
+            raise McpError(ErrorData(code=CONNECTION_CLOSED, message="Connection closed"))
+        if attempts["read_file"] == 2:
+            raise McpError(ErrorData(code=408, message="Timed out"))
+        return "hello"
+
+    @tool
+    async def list_directory(path: str) -> str:
+        """List a directory."""
+        attempts["list_directory"] += 1
+        raise McpError(ErrorData(code=INVALID_PARAMS, message="bad path"))
+
+    @tool
+    async def get_file_info(path: str) -> str:
+        """Get file info."""
+        attempts["get_file_info"] += 1
+        raise FileNotFoundError("npx")
+
+    replies = [
+        AIMessage(content="", tool_calls=[
+            {"name": "read_file", "args": {"path": "a.txt"}, "id": "1"},
+            {"name": "list_directory", "args": {"path": "."}, "id": "2"},
+            {"name": "get_file_info", "args": {"path": "a.txt"}, "id": "3"},
+        ]),
+        AIMessage(content="done"),
+    ]
+    monkeypatch.setattr(agent, "init_chat_model", lambda model: ScriptedModel(replies))
+    graph = agent.build_simple_agent("fake", "system", [read_file, list_directory, get_file_info], retry_base_delay=0)
+
+    result = asyncio.run(graph.ainvoke({"messages": [HumanMessage(content="go")]}))
+
+    assert attempts == {"read_file": 3, "list_directory": 1, "get_file_info": 1}
+    assert result["messages"][2].content == "hello"
+
+
+def test_cache_key_skips_args_orjson_cannot_encode():
+    assert agent.ToolResultCache.make_key("t", "read_file", {"path": "a.txt", "offset": 2 ** 70}) is None
+
+
+def test_readonly_hint_decides_caching(monkeypatch):
+    calls = {"read_text_file": 0, "read_file": 0}
+
+    @tool
+    async def read_text_file(path: str) -> str:
+        """Read a text file."""
+        calls["read_text_file"] += 1
+        return "text"
+
+    @tool
+    async def read_file(path: str) -> str:
+        """Deprecated read that this server marks as not read-only."""
+        calls["read_file"] += 1
+        return "text"
+
+    read_text_file.metadata = {"readOnlyHint": True}
+    read_file.metadata = {"readOnlyHint": False}
+    assert agent.is_readonly_tool(read_text_file)
+    assert not agent.is_readonly_tool(read_file)
+
+    repeat = [
+        {"name": "read_text_file", "args": {"path": "a.txt"}, "id": "1"},
+        {"name": "read_file", "args": {"path": "a.txt"}, "id": "2"},
+    ]
+    replies = [
+        AIMessage(content="", tool_calls=[repeat[0]]),
+        AIMessage(content="", tool_calls=[dict(repeat[0], id="3")]),
+        AIMessage(content="", tool_calls=[repeat[1]]),
+        AIMessage(content="", tool_calls=[dict(repeat[1], id="4")]),
+        AIMessage(content="done"),
+    ]
+    monkeypatch.setattr(agent, "init_chat_model", lambda model: ScriptedModel(replies))
+    graph = agent.build_simple_agent("fake", "system", [read_text_file, read_file])
+
+    asyncio.run(graph.ainvoke({"messages": [HumanMessage(content="go")]}))
+
+    assert calls == {"read_text_file": 1, "read_file": 2}
+
+
+def test_readonly_network_tools_run_concurrently(monkeypatch):
+    running = {"now": 0, "max": 0}
+
+    async def lookup() -> str:
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        await asyncio.sleep(0.05)
+        running["now"] -= 1
+        return "ok"
+
+    @tool
+    async def search_articles(query: str) -> str:
+        """Search PubMed."""
+        return await lookup()
+
+    @tool
+    async def lookup_gene(symbol: str) -> str:
+        """Look up an Ensembl gene."""
+        return await lookup()
+
+    for network_tool in (search_articles, lookup_gene):
+        network_tool.metadata = {"readOnlyHint": True}
+
+    replies = [
+        AIMessage(content="", tool_calls=[
+            {"name": "search_articles", "args": {"query": "TP53"}, "id": "1"},
+            {"name": "lookup_gene", "args": {"symbol": "TP53"}, "id": "2"},
+        ]),
+        AIMessage(content="done"),
+    ]
+    monkeypatch.setattr(agent, "init_chat_model", lambda model: ScriptedModel(replies))
+    graph = agent.build_simple_agent("fake", "system", [search_articles, lookup_gene])
+
+    asyncio.run(graph.ainvoke({"messages": [HumanMessage(content="go")]}))
+
+    assert running["max"] == 2
+
+
+def test_error_cutoff_after_five_failures_and_reset_on_new_turn(monkeypatch):
+    from langgraph.checkpoint.memory import MemorySaver
+
+    @tool
+    async def read_file(path: str) -> str:
+        """Read a file."""
+        raise ValueError("bad path")
+
+    def failing_calls(start, count):
+        return [{"name": "read_file", "args": {"path": f"{i}.txt"}, "id": str(i)} for i in range(start, start + count)]
+
+    replies = [
+        AIMessage(content="", tool_calls=failing_calls(0, 3)),
+        AIMessage(content="", tool_calls=failing_calls(3, 2)),
+        AIMessage(content="next turn"),
+    ]
+    monkeypatch.setattr(agent, "init_chat_model", lambda model: ScriptedModel(replies))
+    graph = agent.build_simple_agent("fake", "system", [read_file], checkpointer=MemorySaver())
+    config = {"configurable": {"thread_id": "t"}}
+
+    result = asyncio.run(graph.ainvoke({"messages": [HumanMessage(content="go")]}, config))
+
+    assert result["error_count"] == 5
+    assert result["messages"][-1].content.startswith("🔴")
+    assert replies == [AIMessage(content="next turn")]
+
+    result = asyncio.run(graph.ainvoke({"messages": [HumanMessage(content="again")]}, config))
+
+    assert result["error_count"] == 0
+    assert result["messages"][-1].content == "next turn"
+
+
+@pytest.mark.parametrize("extra_state", [{}, {"last_ai_tool_idx": 99}])
+def test_error_count_falls_back_when_index_is_missing_or_stale(monkeypatch, extra_state):
+    from langchain_core.messages import ToolMessage
+
+    def failed(call_id):
+        return ToolMessage(content="Error: x", tool_call_id=call_id, additional_kwargs={"is_error": True})
+
+    # 이전 버전 체크포인트처럼 last_ai_tool_idx 없이 저장된 기록
+    history = [
+        HumanMessage(content="go"),
+        AIMessage(content="", tool_calls=[{"name": "read_file", "args": {}, "id": "old"}]),
+        failed("old"),
+        AIMessage(content="", tool_calls=[{"name": "read_file", "args": {}, "id": "a"}, {"name": "read_file", "args": {}, "id": "b"}]),
+        failed("a"),
+        failed("b"),
+    ]
+    monkeypatch.setattr(agent, "init_chat_model", lambda model: ScriptedModel([AIMessage(content="retrying")]))
+    graph = agent.build_simple_agent("fake", "system", [])
+
+    result = asyncio.run(graph.ainvoke({"messages": history, "error_count": 2, **extra_state}))
+
+    # 마지막 도구 호출 이후의 실패 2건만 더해집니다. (이전 호출의 실패는 다시 세지 않음)
+    assert result["error_count"] == 4
+    assert result["last_ai_tool_idx"] == 3
+    assert result["messages"][-1].content == "retrying"